@@ -0,0 +1,121 @@
+
+# Converts the CSV extracts in data/ to Parquet, with the KPI ratio columns and the daily inpatient
+# rollup materialised up front so the dashboard loads ready-made columns instead of recomputing them.
+# Run `python etl.py` after dropping in new extracts; the app also rebuilds any stale output on load.
+import os, tempfile, pandas as pd
+from collections import namedtuple
+from typing import List
+import pyarrow as pa, pyarrow.parquet as pq
+import polars as pl
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+# Stamped into each output's Parquet metadata; bump it whenever the output layout changes (columns, RATIOS,
+# CATEGORY_COLS, row groups) so outputs written by an older etl.py are rebuilt
+ETL_VERSION = "1"
+
+# ratio column -> (numerator, denominator); applied wherever both inputs are present
+RATIOS = {
+    "occ_pct": ("occupied", "beds"),
+    "before_noon_pct": ("discharges_before_noon", "discharges"),
+    "seen_pct": ("seen_within_4h", "arrivals"),
+}
+IP_DAILY_KEYS = ["date","site","division"]
+# Label columns stored dictionary-encoded, so they load as categoricals (integer codes) rather than strings
+CATEGORY_COLS = ["site","division","ward","specialty"]
+IP_DAILY_COLS = ["discharges","discharges_before_noon","nctr_mofd","occupied","beds"]
+ED_SUM_COLS = ["arrivals","admitted_from_ed","left_without_being_seen","ambulance_arrivals","seen_within_4h"]
+
+def path(name: str, ext: str = "parquet") -> str: return os.path.join(DATA_DIR, f"{name}.{ext}")
+
+def add_ratios(df: pd.DataFrame) -> pd.DataFrame:
+    for col,(num,den) in RATIOS.items():
+        if num in df.columns and den in df.columns: df[col] = 100 * df[num] / df[den].where(df[den] != 0)
+    return df
+
+def ip_daily(ip: pd.DataFrame) -> pd.DataFrame:
+    # Kept at the sidebar's filter grain so any site/division selection is a slice of this table
+    return add_ratios(ip.groupby(IP_DAILY_KEYS, as_index=False)[IP_DAILY_COLS].sum())
+
+# The small aggregated frames the dashboard tabs read, built in one pass per windowed table
+Rollups = namedtuple("Rollups", ["ed_hourly","ed_daily","ed_by_hour","seen_trend","ip_daily","th_daily"])
+
+def ratio_exprs(columns) -> List[pl.Expr]:
+    # Polars counterpart of add_ratios; a zero denominator gives null rather than inf
+    return [(100 * pl.col(num) / pl.when(pl.col(den) != 0).then(pl.col(den))).alias(col) for col,(num,den) in RATIOS.items() if num in columns and den in columns]
+
+def to_pandas(df: pl.DataFrame) -> pd.DataFrame:
+    # Arrow-backed pandas columns (Arrow compute for sums and string ops, nulls instead of NaN sentinels); dates
+    # stay datetime64 since they back DatetimeIndexes and Plotly's date axes, and Polars categoricals come back
+    # as pandas categoricals (categories sorted by name, so code order is label order) rather than Arrow dictionaries
+    casts = {c: pd.CategoricalDtype(sorted(df[c].drop_nulls().unique().cast(pl.String).to_list())) for c,dtype in df.schema.items() if dtype == pl.Categorical}
+    return df.to_pandas(use_pyarrow_extension_array=True).astype({**casts, **({"date": "datetime64[ns]"} if "date" in df.columns else {})})
+
+def scan(name: str, start=None, end=None, site: str = "All", division: str = "All") -> pl.LazyFrame:
+    # Lazy scan of an output table with the window filters applied
+    lf = pl.scan_parquet(path(name))
+    if start is not None: lf = lf.filter(pl.col("date").is_between(start, end))
+    if site != "All": lf = lf.filter(pl.col("site") == site)
+    if division != "All": lf = lf.filter(pl.col("division") == division)
+    return lf
+
+def rollups(ed: pl.LazyFrame, ipd: pl.LazyFrame, th: pl.LazyFrame) -> Rollups:
+    # Every rollup is a lazy plan over the windowed scans, collected together so Polars can share the common
+    # ED sub-plan and run them in parallel; results go back to pandas only at the Plotly boundary.
+    # Ratios are re-derived from the rolled-up counts (ratio of sums), since a window may span sites/divisions.
+    ed_sums = pl.col(ED_SUM_COLS).sum()
+    ed_hourly = ed.group_by(["date","hour"]).agg(ed_sums).sort(["date","hour"]).with_columns(ratio_exprs(ED_SUM_COLS))
+    plans = dict(
+        ed_hourly=ed_hourly,
+        ed_daily=ed_hourly.group_by("date").agg(ed_sums).sort("date").with_columns(ratio_exprs(ED_SUM_COLS)),
+        ed_by_hour=ed_hourly.group_by("hour").agg(pl.col("arrivals","ambulance_arrivals").sum()).sort("hour"),
+        seen_trend=ed_hourly.group_by("date").agg(pl.col("seen_pct").mean()).sort("date"),
+        ip_daily=ipd.group_by("date").agg(pl.col(IP_DAILY_COLS).sum()).sort("date").with_columns(ratio_exprs(IP_DAILY_COLS)),
+        # Categorical codes follow first appearance in the file, so specialties are ordered by name explicitly
+        th_daily=th.group_by(["date","specialty"]).agg(pl.col("completed_cases").sum()).sort("date", pl.col("specialty").cast(pl.String)))
+    out = dict(zip(plans, map(to_pandas, pl.collect_all(list(plans.values())))))
+    return Rollups(**{**out, "ed_daily": out["ed_daily"].set_index("date"), "ip_daily": out["ip_daily"].set_index("date")})
+
+# output table -> (source CSV, transform)
+OUTPUTS = {
+    "ed": ("ed", add_ratios),
+    "ambulance": ("ambulance", lambda df: df),
+    "inpatients": ("inpatients", add_ratios),
+    "theatres": ("theatres", lambda df: df),
+    "waiting_list": ("waiting_list", lambda df: df),
+    "ip_daily": ("inpatients", ip_daily),
+}
+
+def write_parquet(df: pd.DataFrame, dst: str):
+    # One row group per month (and per site, where the table has one): the row-group min/max statistics then
+    # let filtered reads skip everything outside the requested date window and site
+    df = df.sort_values("date", kind="stable").astype({c: "category" for c in CATEGORY_COLS if c in df.columns})
+    keys = [df["date"].dt.to_period("M")] + ([df["site"]] if "site" in df.columns else [])
+    schema = pa.Table.from_pandas(df, preserve_index=False).schema
+    schema = schema.with_metadata({**(schema.metadata or {}), b"etl_version": ETL_VERSION.encode()})
+    # Written to a unique temp file and renamed over dst, so a failed write or a concurrent build never leaves a
+    # truncated table in place
+    fd,tmp = tempfile.mkstemp(dir=DATA_DIR, suffix=".tmp"); os.close(fd)
+    try:
+        with pq.ParquetWriter(tmp, schema, compression="zstd") as w:
+            for _,part in df.groupby(keys, sort=True, observed=True, dropna=False): w.write_table(pa.Table.from_pandas(part, schema=schema, preserve_index=False))
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+def is_stale(dst: str, src_path: str) -> bool:
+    # Missing, older than its CSV, unreadable, or written by a different ETL_VERSION
+    if not os.path.exists(dst) or os.path.getmtime(dst) < os.path.getmtime(src_path): return True
+    try: return (pq.read_schema(dst).metadata or {}).get(b"etl_version") != ETL_VERSION.encode()
+    except (OSError, pa.ArrowInvalid): return True
+
+def build(force: bool = False) -> float:
+    # Only stale outputs are rewritten; returns the newest output mtime as a data version
+    for name,(src,transform) in OUTPUTS.items():
+        dst = path(name); src_path = path(src, "csv")
+        if force or is_stale(dst, src_path):
+            write_parquet(transform(pd.read_csv(src_path, engine="pyarrow", dtype_backend="pyarrow").astype({"date": "datetime64[ns]"})), dst)
+    return max(os.path.getmtime(path(name)) for name in OUTPUTS)
+
+if __name__ == "__main__":
+    build(force=True)
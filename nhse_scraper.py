@@ -1,9 +1,15 @@
 
-import io, os, zipfile, pandas as pd, requests
+import json, os, re, tempfile, zipfile, numpy as np, pandas as pd, requests
+import pyarrow as pa, pyarrow.csv as pacsv, pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import List
+from functools import partial
+from typing import List, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
 
-NHSE_HEADERS = {"User-Agent": "HospitalFlowDashboard/1.0 (education use)"}
+NHSE_HEADERS = {"User-Agent": "HospitalFlowDashboard/1.0 (education use)", "Accept-Encoding": "gzip, deflate"}
 CACHE_DIR = os.path.join(os.path.dirname(__file__), "data", "nhse_cache"); os.makedirs(CACHE_DIR, exist_ok=True)
 
 @dataclass
@@ -11,8 +17,51 @@ class PeerSet:
     providers: List[str]
 
 def _cache_path(name: str) -> str: return os.path.join(CACHE_DIR, name)
-def _download(url: str) -> bytes:
-    r = requests.get(url, headers=NHSE_HEADERS, timeout=60); r.raise_for_status(); return r.content
+
+# Pooled keep-alive connections: repeat fetches from the same NHSE host skip the TCP/TLS handshake
+_SESSION = requests.Session(); _SESSION.headers.update(NHSE_HEADERS)
+_SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=3))
+
+@contextmanager
+def _open_url(url: str, headers: Optional[dict]=None):
+    # Streamed response whose r.raw is the decoded body, so parsers can consume it without buffering the whole
+    # download; a 304 Not Modified (conditional GET) is passed through for the caller to check
+    with _SESSION.get(url, headers=headers, timeout=60, stream=True) as r:
+        if r.status_code!=304: r.raise_for_status()
+        r.raw.decode_content=True; yield r
+
+# Cache validators live next to each cached file: {"url", "etag", "last_modified"} of the response it came from
+def _read_validators(path: str) -> dict:
+    try:
+        with open(path) as f: return json.load(f)
+    except (OSError, ValueError): return {}
+
+def _conditional_headers(url: str, validators: dict) -> dict:
+    if validators.get("url")!=url: return {}
+    return {k:v for k,v in (("If-None-Match",validators.get("etag")),("If-Modified-Since",validators.get("last_modified"))) if v}
+
+def _replace(dst: str, write):
+    # write(tmp) into a unique temp file next to dst, then rename it over dst: concurrent readers and writers
+    # only ever see the old file or the complete new one
+    fd,tmp=tempfile.mkstemp(dir=os.path.dirname(dst), suffix=".tmp"); os.close(fd)
+    try: write(tmp); os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+def _write_json(obj, path: str):
+    with open(path, "w") as f: json.dump(obj, f)
+
+def _persist(df: pd.DataFrame, cache: str, validators: dict):
+    # Validators are written only after the data they describe, so a failed write never marks stale data as fresh
+    _replace(cache, partial(df.to_parquet, engine="pyarrow", compression="zstd"))
+    _replace(cache+".json", partial(_write_json, validators))
+
+# Multithreaded Arrow CSV parse; strings stay Arrow-backed instead of boxed Python objects
+_CSV_READ = pacsv.ReadOptions(block_size=8<<20, use_threads=True)
+_CSV_CONVERT = pacsv.ConvertOptions(strings_can_be_null=True)
+def _read_csv(src) -> pd.DataFrame:
+    return pacsv.read_csv(src, read_options=_CSV_READ, convert_options=_CSV_CONVERT).to_pandas(types_mapper=pd.ArrowDtype)
 
 AEM_MONTH_FILES = [
     ("2025-03","https://www.england.nhs.uk/statistics/wp-content/uploads/sites/2/2025/04/A-E-Monthly-March-2025.csv"),
@@ -21,25 +70,69 @@ AEM_MONTH_FILES = [
     ("2024-12","https://www.england.nhs.uk/statistics/wp-content/uploads/sites/2/2025/01/A-E-Monthly-December-2024.csv"),
 ]
 
-def fetch_ae_monthly_provider(peers: PeerSet) -> pd.DataFrame:
-    frames=[]
-    for label,url in AEM_MONTH_FILES:
-        cache=_cache_path(f"ae_{label}.csv")
-        if os.path.exists(cache): df=pd.read_csv(cache)
-        else:
-            b=_download(url); df=pd.read_csv(io.BytesIO(b)); df.to_csv(cache, index=False)
-        df["period"]=label; frames.append(df)
-    ae=pd.concat(frames, ignore_index=True)
-    prov_col = next((c for c in ae.columns if c.lower() in ["provider","provider name","provider_name","organisation","provider code"]), None)
-    if prov_col is None:
-        if "Provider Name" in ae.columns: prov_col="Provider Name"
-        else: raise ValueError("Provider column not found in A&E monthly file.")
-    ae["PROVIDER"]=ae[prov_col].astype(str)
+def _compact(df: pd.DataFrame) -> pd.DataFrame:
+    # Smallest integer widths that fit, and Arrow strings in place of boxed Python objects; floats (mostly
+    # percentages) stay float64 so the 4h figures keep full precision
+    for c in df.select_dtypes("integer").columns: df[c]=pd.to_numeric(df[c], downcast="integer")
+    obj=df.select_dtypes("object").columns
+    if len(obj): df[obj]=df[obj].astype(pd.ArrowDtype(pa.string()))
+    return df
+
+_PROVIDER_COL_RE = re.compile(r"^(?:provider|provider name|provider_name|organisation|provider code)$", re.I)
+
+def _provider_col(columns) -> str:
+    columns=pd.Index(columns); hits=columns[columns.str.contains(_PROVIDER_COL_RE)]
+    if len(hits): return hits[0]
+    if "Provider Name" in columns: return "Provider Name"
+    raise ValueError("Provider column not found in A&E monthly file.")
+
+def _select_cols(columns, columns_regex: str) -> List[str]:
+    # The provider column is always kept so peer filtering still works on a pruned frame
+    columns=pd.Index(columns); prov_col=_provider_col(columns)
+    return columns[columns.str.contains(columns_regex, case=False, regex=True) | (columns==prov_col)].tolist()
+
+def _fetch_one_month(item, writer: ThreadPoolExecutor, columns_regex: Optional[str]=None):
+    label,url=item; cache=_cache_path(f"ae_{label}.parquet"); pending=None; df=None
+    cached=os.path.exists(cache)
+    # Conditional GET against the cached copy's validators; a 304 means the cache is still current
+    headers=_conditional_headers(url, _read_validators(cache+".json")) if cached else {}
+    try:
+        with _open_url(url, headers) as r:
+            if r.status_code!=304:
+                df=_read_csv(r.raw)
+                validators={"url":url, "etag":r.headers.get("ETag"), "last_modified":r.headers.get("Last-Modified")}
+                pending=writer.submit(_persist, df, cache, validators)
+                if columns_regex is not None: df=df[_select_cols(df.columns, columns_regex)]
+    except (requests.RequestException, Urllib3HTTPError):
+        # offline or cut off mid-body (r.raw raises urllib3 errors unwrapped): fall back to the cached copy if any
+        if not cached: raise
+    if df is None:
+        cols=None if columns_regex is None else _select_cols(pq.read_schema(cache).names, columns_regex)
+        df=pd.read_parquet(cache, columns=cols, engine="pyarrow", dtype_backend="pyarrow", memory_map=True)
+    # assign returns a new frame, so the background writer never sees the added column
+    return df.assign(period=label), pending
+
+def fetch_ae_monthly_provider(peers: PeerSet, columns_regex: Optional[str]=None) -> pd.DataFrame:
+    # columns_regex (case-insensitive) prunes the returned columns; warm reads only decode the matching Parquet columns.
+    # Downloads are network-bound and requests releases the GIL, so months are fetched concurrently;
+    # Parquet cache writes queue on a single background thread instead of holding up the next download
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        with ThreadPoolExecutor(max_workers=min(8,len(AEM_MONTH_FILES))) as ex:
+            results=list(ex.map(partial(_fetch_one_month, writer=writer, columns_regex=columns_regex), AEM_MONTH_FILES))
+        ae=pd.concat([df for df,_ in results], ignore_index=True, copy=False)
+        for _,pending in results:
+            if pending is not None: pending.result()
+    prov_col=_provider_col(ae.columns)
+    # Categorise first, then stringify the categories: name handling runs once per unique provider, not per row
+    prov=ae[prov_col].astype("category")
+    ae["PROVIDER"]=prov.cat.rename_categories(prov.cat.categories.astype(str))
     if peers.providers:
-        mask=False
-        for p in peers.providers: mask = mask | ae["PROVIDER"].str.lower().str.contains(str(p).lower())
-        ae = ae[mask]
-    return ae
+        # One regex alternation over the ~200 unique providers, mapped back to rows via the category codes
+        pat="|".join(re.escape(str(p).strip().lower()) for p in peers.providers if str(p).strip())
+        hit=np.asarray(ae["PROVIDER"].cat.categories.str.lower().str.contains(pat, regex=True))
+        ae = ae[np.append(hit, False)[ae["PROVIDER"].cat.codes.to_numpy()]]  # code -1 (missing name) never matches
+        ae = ae.assign(PROVIDER=ae["PROVIDER"].cat.remove_unused_categories())
+    return _compact(ae)
 
 def fetch_ambulance_handover_timeseries(peers: PeerSet)->pd.DataFrame:
     # Placeholder: return empty; UI will guide user to share mapping
@@ -1,123 +1,223 @@
 
+import re
 import streamlit as st, pandas as pd, numpy as np
 import plotly.express as px, plotly.graph_objects as go
+import polars as pl
 from datetime import datetime
+import etl
+import nhse_scraper as ns
 
 st.set_page_config(page_title="Hospital Flow Command Centre", layout="wide")
+# Copy-on-write: filtered views share buffers with the source frames until a column is actually written
+pd.set_option("mode.copy_on_write", True)
+
+# Only the columns the tabs actually use are decoded from each Parquet table
+AMB_COLS = ["date","slot","arrivals","queue","handover_over_15m","handover_over_30m","handover_over_60m"]
+IP_COLS = ["date","site","division","ward","beds","occupied","admissions","discharges","discharges_before_noon","nctr_mofd","stranded_7d","super_stranded_21d","occ_pct"]
+WL_COLS = ["date","total_waiting","over_52_weeks","over_65_weeks","over_78_weeks"]
+
+def read_table(lf, columns):
+    # Measures stay Arrow-backed; the dictionary-encoded labels load as categoricals so filters, sorts and
+    # group-bys run on integer codes
+    return etl.to_pandas(lf.select(columns).collect())
+
+# Parquet outputs (with KPI ratios and the daily inpatient rollup) are rebuilt on load whenever a CSV is newer;
+# the data version is part of every data cache key below, so a rebuilt table is re-read
+data_version = etl.build()
 
 @st.cache_data
-def load_data():
-    ed = pd.read_csv("data/ed.csv", parse_dates=["date"])
-    amb = pd.read_csv("data/ambulance.csv", parse_dates=["date"])
-    ip = pd.read_csv("data/inpatients.csv", parse_dates=["date"])
-    th = pd.read_csv("data/theatres.csv", parse_dates=["date"])
-    wl = pd.read_csv("data/waiting_list.csv", parse_dates=["date"])
-    return ed, amb, ip, th, wl
+def get_sidebar_options(version):
+    # Date span and label lists for the sidebar, computed once per data version
+    span = pl.concat([etl.scan("ed").select("date"), etl.scan("inpatients").select("date")]).select(
+        min_date=pl.col("date").min(), max_date=pl.col("date").max()).collect().row(0, named=True)
+    labels = etl.scan("inpatients").select(pl.col("site","division").cast(pl.String)).unique().collect()
+    return {**span, "sites": sorted(labels["site"].unique().to_list()), "divisions": sorted(labels["division"].unique().to_list())}
+
+@st.cache_data(ttl=3600)
+def load_window(start, end, site, division, version):
+    # Row-level frames for the charts that plot individual slots/wards
+    amb = read_table(etl.scan("ambulance", start, end), AMB_COLS)
+    wl = read_table(etl.scan("waiting_list", start, end), WL_COLS)
+    # Row groups come back month x site, so inpatient rows are re-sorted to keep site/division order within a day
+    ip = read_table(etl.scan("inpatients", start, end, site, division), IP_COLS).sort_values(etl.IP_DAILY_KEYS)
+    # Sorted date index keeps the "latest day" picks as binary-search slices
+    return tuple(df.set_index("date").sort_index(kind="stable") for df in (amb, ip, wl))
 
-ed, amb, ip, th, wl = load_data()
+@st.cache_data(ttl=3600)
+def daily_rollups(start, end, site, division, version):
+    # Keyed on the filter window, not a hash of the frames
+    return etl.rollups(etl.scan("ed", start, end, site), etl.scan("ip_daily", start, end, site, division), etl.scan("theatres", start, end))
+
+options = get_sidebar_options(data_version)
 
 with st.sidebar:
     st.title("Filters")
-    min_date = min(ed["date"].min(), ip["date"].min())
-    max_date = max(ed["date"].max(), ip["date"].max())
-    date_range = st.date_input("Date range", (pd.to_datetime(max_date) - pd.Timedelta(days=6), pd.to_datetime(max_date)))
-    sites = sorted(ip["site"].unique().tolist())
-    site = st.selectbox("Site", ["All"] + sites)
-    divisions = sorted(ip["division"].unique().tolist())
-    division = st.selectbox("Division (inpatients)", ["All"] + divisions)
+    max_date = pd.to_datetime(options["max_date"])
+    date_range = st.date_input("Date range", (max_date - pd.Timedelta(days=6), max_date))
+    site = st.selectbox("Site", ["All"] + options["sites"])
+    division = st.selectbox("Division (inpatients)", ["All"] + options["divisions"])
     st.markdown("---")
     target_occ = st.slider("Target bed occupancy %", 80, 98, 92)
     admit_conv = st.slider("ED admission conversion %", 10, 40, 25)
 
-start, end = pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1]) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
-edf = ed[(ed["date"] >= start) & (ed["date"] <= end)].copy()
-ambf = amb[(amb["date"] >= start) & (amb["date"] <= end)].copy()
-ipf = ip[(ip["date"] >= start) & (ip["date"] <= end)].copy()
-thf = th[(th["date"] >= start) & (th["date"] <= end)].copy()
-wlf = wl[(wl["date"] >= start) & (wl["date"] <= end)].copy()
+@st.cache_data
+def to_window(date_range):
+    # Sidebar dates -> inclusive [start, end-of-day] datetime64[ns] bounds, converted once per distinct selection
+    return np.datetime64(date_range[0], "ns"), np.datetime64(date_range[1], "ns") + np.timedelta64(1, "D") - np.timedelta64(1, "s")
+
+start, end = to_window(tuple(date_range))
+window = (start, end, site, division, data_version)
+ambf, ipf, wlf = load_window(*window)
 
-if site != "All":
-    edf = edf[edf.get("site","Main").eq(site)] if "site" in edf.columns else edf
-    ipf = ipf[ipf["site"] == site]
-if division != "All":
-    ipf = ipf[ipf["division"] == division]
+# Every tab reads from these small rollups instead of re-scanning the window
+rollups = daily_rollups(*window)
+ed_daily, ip_daily = rollups.ed_daily, rollups.ip_daily
 
-def safe_div(a,b): return (a/b) if b else 0
+def latest_day(df):
+    # Windowed frames come back date-sorted, so the latest day is the tail from the searchsorted start of the
+    # last row's date: an O(log n) zero-copy slice instead of an index.max() scan plus a label lookup
+    if df.empty: return df
+    dates = df.index.values
+    return df.iloc[dates.searchsorted(dates[-1]):]
+
+# "HH:MM" label of each 15-minute ambulance slot, looked up by slot number
+SLOT_TIMES = np.array([f"{(s*15)//60:02d}:{(s*15)%60:02d}" for s in range(96)])
+
+# A&E column discovery: one compiled pattern per role, matched against the header in a single pass
+ATTEND_COL_RE = re.compile(r"^(?!.*%).*attend", re.I)
+PCT_WITHIN4_COL_RE = re.compile(r"% within 4", re.I)
+WITHIN4_COL_RE = re.compile(r"^(?!.*%).*within 4", re.I)
+def first_col(columns, pat):
+    hits = columns[columns.str.contains(pat)]
+    return hits[0] if len(hits) else None
+def peer_stats(pct, is_peer):
+    # Peer mean (skipping gaps), descending min-method rank and delta vs that mean, all on plain ndarrays
+    peers = pct[is_peer & ~np.isnan(pct)]
+    peer_avg = peers.mean() if len(peers) else np.nan
+    return peer_avg, np.sort(-pct).searchsorted(-pct) + 1, pct - peer_avg
+
+# Trend traces above LTTB_THRESHOLD points are cut to LTTB_POINTS before they go to Plotly; heatmaps keep at most HEATMAP_MAX_COLS columns
+LTTB_THRESHOLD, LTTB_POINTS, HEATMAP_MAX_COLS = 3000, 2000, 200
+def lttb_indices(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: keep the end points and, per bucket, the point making the largest
+    # triangle with the previous pick and the mean of the next bucket
+    n = len(x)
+    if n <= n_out or n_out < 3: return np.arange(n)
+    edges = np.append(np.linspace(1, n - 1, n_out - 1).astype(int), n); y = np.nan_to_num(y)
+    out = np.empty(n_out, dtype=np.int64); out[0], out[-1] = 0, n - 1; a = 0
+    for i in range(n_out - 2):
+        lo, hi, nhi = edges[i], edges[i+1], edges[i+2]
+        cx, cy = x[hi:nhi].mean(), y[hi:nhi].mean()
+        a = out[i+1] = lo + np.argmax(np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a])))
+    return out
+def downsample(df, x, cols):
+    # Wide-form traces share one x, so the LTTB picks of every column are kept
+    if len(df) <= LTTB_THRESHOLD: return df
+    xs = df[x].to_numpy(); xs = (xs.astype("datetime64[ns]").astype(np.int64) if np.issubdtype(xs.dtype, np.datetime64) else xs).astype(float)
+    return df.iloc[np.unique(np.concatenate([lttb_indices(xs, df[c].to_numpy(dtype=float, na_value=np.nan), LTTB_POINTS) for c in cols]))]
+def cap_columns(mat, cols):
+    # Averages runs of consecutive columns (ignoring gaps) so a long window renders at most HEATMAP_MAX_COLS cells wide
+    if mat.shape[1] <= HEATMAP_MAX_COLS: return mat, cols
+    bins = np.array_split(np.arange(mat.shape[1]), HEATMAP_MAX_COLS); counts = np.column_stack([(~np.isnan(mat[:, b])).sum(axis=1) for b in bins])
+    sums = np.column_stack([np.nansum(mat[:, b], axis=1) for b in bins])
+    return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan), cols[[b[0] for b in bins]]
+
+# Figures are cached on the filter window too: reruns from widgets that leave the window alone (the occupancy
+# and conversion sliders, the Benchmarking controls) re-send the stored figure instead of rebuilding it
+@st.cache_data(ttl=3600, show_spinner=False)
+def trend_figure(window, rollup, y, title):
+    df = getattr(daily_rollups(*window), rollup); ys = [y] if isinstance(y, str) else y
+    df = downsample(df.reset_index() if df.index.name == "date" else df, "date", ys)
+    # WebGL traces built directly, without the px wide-to-long reshape; labelled the way px.line labels them
+    fig = go.Figure([go.Scattergl(x=df["date"], y=df[c], mode="lines+markers", name=c if len(ys) > 1 else "", showlegend=len(ys) > 1) for c in ys])
+    return fig.update_layout(title=title, xaxis_title="date", yaxis_title=ys[0] if len(ys) == 1 else "value", legend_title_text="variable", uirevision="keep")
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def heatmap_figure(window):
+    # hour x day matrix filled straight from the rollup's codes; (hour, day) pairs with no rows stay blank
+    edh = daily_rollups(*window).ed_hourly
+    days, day_idx = np.unique(edh["date"].to_numpy(), return_inverse=True)
+    mat = np.full((24, len(days)), np.nan); mat[edh["hour"].to_numpy(), day_idx] = edh["arrivals"].to_numpy(dtype=float)
+    mat, days = cap_columns(mat, days)
+    return px.imshow(mat, x=pd.DatetimeIndex(days), y=np.arange(24), labels=dict(x="date", y="hour"), aspect="auto", title="Arrivals heatmap by hour")
+
+# NHSE fetch results, kept for a day per sorted peer tuple
+@st.cache_data(ttl=86400, show_spinner=False)
+def cached_ae(peers_key, columns_regex=None): return ns.fetch_ae_monthly_provider(ns.PeerSet(list(peers_key)), columns_regex=columns_regex)
+@st.cache_data(ttl=86400, show_spinner=False)
+def cached_ambulance(peers_key): return ns.fetch_ambulance_handover_timeseries(ns.PeerSet(list(peers_key)))
+@st.cache_data(ttl=86400, show_spinner=False)
+def cached_discharge(peers_key): return ns.fetch_acute_discharge_timeseries(ns.PeerSet(list(peers_key)))
 
 st.title("Hospital Flow Command Centre")
 tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["Ops Overview","ED & Ambulance","Beds & Flow","Discharge","Theatres & Elective","Benchmarking"])
 
 with tab1:
     st.subheader("At-a-glance")
-    last_day = ipf["date"].max()
-    ip_day = ipf[ipf["date"] == last_day]
-    ed_day = edf[edf["date"] == last_day]
-    todays_arrivals = ed_day["arrivals"].sum()
+    last_day = ipf.index.max()
+    # One reduction per rollup; every headline ratio is then scalar arithmetic on the summed counts
+    ip_day = ip_daily.loc[last_day:last_day, ["beds","occupied","discharges","discharges_before_noon"]].sum().to_dict()
+    ed_day = ed_daily.loc[last_day:last_day, ["arrivals","ambulance_arrivals","seen_within_4h"]].sum().to_dict()
+    kpis = {"perf4h": 100 * ed_day["seen_within_4h"] / max(ed_day["arrivals"], 1),
+            "occ_pct": 100 * ip_day["occupied"] / max(ip_day["beds"], 1),
+            "before_noon_pct": 100 * ip_day["discharges_before_noon"] / max(ip_day["discharges"], 1)}
+    todays_arrivals = ed_day["arrivals"]
     todays_admits = int(todays_arrivals * (st.session_state.get("admit_conv",25)/100))
-    todays_discharges = ip_day["discharges"].sum()
-    beds = ip_day["beds"].sum(); occ = ip_day["occupied"].sum()
+    todays_discharges = ip_day["discharges"]
+    beds = ip_day["beds"]; occ = ip_day["occupied"]
     target_occ_v = beds * target_occ / 100
     gap = max(0, (occ + todays_admits - todays_discharges) - target_occ_v)
     c1,c2,c3,c4,c5,c6=st.columns(6)
     c1.metric("ED arrivals (today)", int(todays_arrivals))
-    c2.metric("Ambulance arrivals (today)", int(ed_day["ambulance_arrivals"].sum()))
-    c3.metric("4-hour performance", f"{int(100*safe_div(ed_day['seen_within_4h'].sum(), max(ed_day['arrivals'].sum(),1)))}%")
-    c4.metric("Bed occupancy", f"{int(100*safe_div(occ, max(beds,1)))}%")
-    c5.metric("Discharges before noon", f"{int(100*safe_div(ip_day['discharges_before_noon'].sum(), max(ip_day['discharges'].sum(),1)))}%")
+    c2.metric("Ambulance arrivals (today)", int(ed_day["ambulance_arrivals"]))
+    c3.metric("4-hour performance", f"{int(kpis['perf4h'])}%")
+    c4.metric("Bed occupancy", f"{int(kpis['occ_pct'])}%")
+    c5.metric("Discharges before noon", f"{int(kpis['before_noon_pct'])}%")
     c6.metric("Capacity gap vs target occ", int(gap), " beds")
 
     colA, colB = st.columns(2)
     with colA:
-        ed_trend = edf.groupby("date")[["arrivals","admitted_from_ed"]].sum().reset_index()
-        st.plotly_chart(px.line(ed_trend, x="date", y=["arrivals","admitted_from_ed"], markers=True, title="ED arrivals & admissions"), use_container_width=True)
+        st.plotly_chart(trend_figure(window, "ed_daily", ["arrivals","admitted_from_ed"], "ED arrivals & admissions"), use_container_width=True)
     with colB:
-        occ_trend = ipf.groupby("date")[["occupied","beds"]].sum().reset_index()
-        occ_trend["occ_pct"] = (occ_trend["occupied"]/occ_trend["beds"])*100
-        st.plotly_chart(px.line(occ_trend, x="date", y="occ_pct", markers=True, title="Bed occupancy %"), use_container_width=True)
+        st.plotly_chart(trend_figure(window, "ip_daily", "occ_pct", "Bed occupancy %"), use_container_width=True)
 
 with tab2:
     st.subheader("ED live picture")
-    edh = edf.groupby(["date","hour"])[["arrivals","admitted_from_ed","left_without_being_seen","ambulance_arrivals","seen_within_4h"]].sum().reset_index()
-    pivot = edh.pivot(index="hour", columns="date", values="arrivals")
-    st.plotly_chart(px.imshow(pivot, aspect="auto", title="Arrivals heatmap by hour"), use_container_width=True)
+    st.plotly_chart(heatmap_figure(window), use_container_width=True)
     col1,col2=st.columns(2)
-    col1.plotly_chart(px.bar(edh.groupby("hour")[["arrivals","ambulance_arrivals"]].sum().reset_index(), x="hour", y=["arrivals","ambulance_arrivals"], barmode="group", title="Arrivals by hour"), use_container_width=True)
-    edh["seen_pct"] = 100*(edh["seen_within_4h"]/edh["arrivals"].replace(0,np.nan))
-    col2.plotly_chart(px.line(edh.groupby("date")["seen_pct"].mean().reset_index(), x="date", y="seen_pct", markers=True, title="4-hour performance trend"), use_container_width=True)
+    col1.plotly_chart(px.bar(rollups.ed_by_hour, x="hour", y=["arrivals","ambulance_arrivals"], barmode="group", title="Arrivals by hour"), use_container_width=True)
+    col2.plotly_chart(trend_figure(window, "seen_trend", "seen_pct", "4-hour performance trend"), use_container_width=True)
     st.subheader("Ambulance handovers")
-    amb_day = ambf[ambf["date"] == ambf["date"].max()].sort_values("slot")
-    amb_day["time"] = pd.to_datetime(amb_day["slot"]*15, unit="m").dt.strftime('%H:%M')
+    amb_day = latest_day(ambf).sort_values("slot")
+    amb_day["time"] = SLOT_TIMES[amb_day["slot"].to_numpy(dtype=np.int64)]
     fig5 = go.Figure()
-    fig5.add_trace(go.Scatter(x=amb_day["time"], y=amb_day["queue"], mode="lines+markers", name="Queue"))
+    fig5.add_trace(go.Scattergl(x=amb_day["time"], y=amb_day["queue"], mode="lines+markers", name="Queue"))
     fig5.add_trace(go.Bar(x=amb_day["time"], y=amb_day["arrivals"], name="Arrivals", opacity=0.4))
-    fig5.update_layout(title="Today's ambulance arrivals and queue (15-min slots)")
+    fig5.update_layout(title="Today's ambulance arrivals and queue (15-min slots)", uirevision="keep")
     st.plotly_chart(fig5, use_container_width=True)
+    handover = amb_day[["handover_over_15m","handover_over_30m","handover_over_60m"]].sum()
     c3,c4,c5 = st.columns(3)
-    c3.metric(">15m", int(amb_day["handover_over_15m"].sum()))
-    c4.metric(">30m", int(amb_day["handover_over_30m"].sum()))
-    c5.metric(">60m", int(amb_day["handover_over_60m"].sum()))
+    c3.metric(">15m", int(handover["handover_over_15m"]))
+    c4.metric(">30m", int(handover["handover_over_30m"]))
+    c5.metric(">60m", int(handover["handover_over_60m"]))
 
 with tab3:
     st.subheader("Bed state & flow by ward")
-    latest = ipf[ipf["date"] == ipf["date"].max()].copy()
-    latest["occ_pct"] = (latest["occupied"]/latest["beds"])*100
+    latest = latest_day(ipf)
     st.plotly_chart(px.bar(latest.sort_values("occ_pct", ascending=False), x="ward", y="occ_pct", hover_data=["occupied","beds","division","site"], title="Ward occupancy % (latest)"), use_container_width=True)
     st.dataframe(latest[["site","division","ward","beds","occupied","nctr_mofd","stranded_7d","super_stranded_21d","admissions","discharges","discharges_before_noon"]].sort_values(["site","division","ward"]), use_container_width=True)
 
 with tab4:
     st.subheader("Discharge pipeline and performance")
-    daily = ipf.groupby("date")[["discharges","discharges_before_noon","nctr_mofd","occupied","beds"]].sum().reset_index()
-    daily["before_noon_pct"] = 100 * (daily["discharges_before_noon"] / daily["discharges"].replace(0,np.nan))
-    st.plotly_chart(px.line(daily, x="date", y=["discharges","discharges_before_noon"], markers=True, title="Discharges and before-noon discharges"), use_container_width=True)
+    st.plotly_chart(trend_figure(window, "ip_daily", ["discharges","discharges_before_noon"], "Discharges and before-noon discharges"), use_container_width=True)
     col1,col2=st.columns(2)
-    col1.plotly_chart(px.line(daily, x="date", y="before_noon_pct", markers=True, title="% Discharged before noon"), use_container_width=True)
-    col2.plotly_chart(px.line(daily, x="date", y="nctr_mofd", markers=True, title="NCTR/MOFD patients"), use_container_width=True)
+    col1.plotly_chart(trend_figure(window, "ip_daily", "before_noon_pct", "% Discharged before noon"), use_container_width=True)
+    col2.plotly_chart(trend_figure(window, "ip_daily", "nctr_mofd", "NCTR/MOFD patients"), use_container_width=True)
 
 with tab5:
     st.subheader("Elective performance")
-    t = thf.groupby(["date","specialty"])[["sessions","planned_cases","completed_cases","cancelled_on_the_day"]].sum().reset_index()
-    st.plotly_chart(px.bar(t, x="date", y="completed_cases", color="specialty", title="Completed cases per day by specialty"), use_container_width=True)
-    wl_latest = wlf[wlf["date"] == wlf["date"].max()]
+    st.plotly_chart(px.bar(rollups.th_daily, x="date", y="completed_cases", color="specialty", title="Completed cases per day by specialty"), use_container_width=True)
+    wl_latest = latest_day(wlf)
     c1,c2,c3,c4 = st.columns(4)
     c1.metric("Waiting list (total)", int(wl_latest["total_waiting"].sum()))
     c2.metric(">52 weeks", int(wl_latest["over_52_weeks"].sum()))
@@ -127,24 +227,24 @@ with tab5:
 with tab6:
     st.subheader("Benchmarking")
     st.caption("Use the controls below to fetch NHSE data and benchmark Main vs Peers.")
-    import nhse_scraper as ns
+
     with st.expander("NHSE data fetchers"):
         peers_text = st.text_input("Peers (comma-separated; provider names or ODS codes)", value="Portsmouth, University Hospitals Sussex, University Hospitals Dorset")
         peers = [p.strip() for p in peers_text.split(",") if p.strip()]
         col1,col2 = st.columns(2)
         if col1.button("Fetch A&E monthly (provider)"):
             try:
-                df = ns.fetch_ae_monthly_provider(ns.PeerSet(peers))
+                df = cached_ae(tuple(sorted(peers)))
                 st.success(f"Fetched {len(df):,} rows"); st.dataframe(df.head(50))
             except Exception as e: st.error(str(e))
         if col2.button("Fetch Ambulance handover time series"):
             try:
-                df = ns.fetch_ambulance_handover_timeseries(ns.PeerSet(peers))
+                df = cached_ambulance(tuple(sorted(peers)))
                 st.success(f"Fetched {len(df):,} rows"); st.dataframe(df.head(50))
             except Exception as e: st.error(str(e))
         if st.button("Fetch Acute Discharge SitRep time series"):
             try:
-                df = ns.fetch_acute_discharge_timeseries(ns.PeerSet(peers))
+                df = cached_discharge(tuple(sorted(peers)))
                 st.success(f"Fetched {len(df):,} rows"); st.dataframe(df.head(50))
             except Exception as e: st.error(str(e))
 
@@ -155,25 +255,27 @@ with tab6:
     peer_sites = st.multiselect("Peers", default_peers, default=default_peers)
     if st.button("Run peer comparison"):
         try:
-            ae = ns.fetch_ae_monthly_provider(ns.PeerSet([main_site]+peer_sites))
+            ae = cached_ae(tuple(sorted([main_site]+peer_sites)), columns_regex=r"attend|within 4")
             # pick columns
-            total_col = next((c for c in ae.columns if ("attend" in c.lower()) and "%" not in c.lower()), None)
-            pct_col = next((c for c in ae.columns if "% within 4" in c.lower()), None)
-            within4_col = next((c for c in ae.columns if "within 4" in c.lower() and "%" not in c.lower()), None)
+            total_col, pct_col, within4_col = (first_col(ae.columns, pat) for pat in (ATTEND_COL_RE, PCT_WITHIN4_COL_RE, WITHIN4_COL_RE))
             ae["period_dt"] = pd.to_datetime(ae["period"] + "-01")
-            ae = ae.sort_values(["PROVIDER","period_dt"], ascending=[True, False]).groupby("PROVIDER").head(3)
+            # Latest three months per provider from a per-group rank, without globally sorting every provider-month
+            ae = ae[ae.groupby("PROVIDER", observed=True, sort=False)["period_dt"].rank(method="first", ascending=False) <= 3]
+            # One float64 buffer per source column, then a single ufunc expression into within4_pct
             if pct_col:
-                ae["within4_pct"] = ae[pct_col].astype(float)
-                if ae["within4_pct"].mean() <= 1.0: ae["within4_pct"]*=100.0
+                vals = ae[pct_col].astype("float64").to_numpy()
+                ae["within4_pct"] = vals * (100.0 if (~np.isnan(vals)).any() and np.nanmean(vals) <= 1.0 else 1.0)
             elif within4_col and total_col:
-                ae["within4_pct"] = (ae[within4_col].astype(float)/ae[total_col].replace(0,np.nan).astype(float))*100.0
-            agg = ae.groupby("PROVIDER").agg(within4_12wk=("within4_pct","mean"), attendances_3m=(total_col,"sum")).reset_index()
-            mask = agg["PROVIDER"].str.contains(main_site, case=False, na=False)
-            for p in peer_sites: mask = mask | agg["PROVIDER"].str.contains(p, case=False, na=False)
-            view = agg[mask].copy()
-            peer_avg = view.loc[~view["PROVIDER"].str.contains(main_site, case=False, na=False), "within4_12wk"].mean()
-            view["rank"] = view["within4_12wk"].rank(ascending=False, method="min").astype(int)
-            view["delta_vs_peer_avg"] = view["within4_12wk"] - peer_avg
+                num, den = (ae[c].astype("float64").to_numpy() for c in (within4_col, total_col))
+                ae["within4_pct"] = np.where(den != 0, 100.0 * num / np.where(den != 0, den, 1.0), np.nan)
+            agg = (pl.from_pandas(ae[["PROVIDER","within4_pct",total_col]]).group_by("PROVIDER")
+                   .agg(pl.col("within4_pct").mean().alias("within4_12wk"), pl.col(total_col).sum().alias("attendances_3m")).sort("PROVIDER").pipe(etl.to_pandas))
+            # One Arrow regex scan over the lower-cased names instead of a str.contains pass per peer
+            agg["PROVIDER_lc"] = agg["PROVIDER"].astype("string[pyarrow]").str.lower()
+            main_pat = re.escape(main_site.lower())
+            view = agg[agg["PROVIDER_lc"].str.contains("|".join([main_pat] + [re.escape(p.lower()) for p in peer_sites]), na=False)]
+            is_peer = ~view["PROVIDER_lc"].str.contains(main_pat, na=False).to_numpy(dtype=bool)
+            peer_avg, view["rank"], view["delta_vs_peer_avg"] = peer_stats(view["within4_12wk"].to_numpy(dtype=float, na_value=np.nan), is_peer)
             fig = px.bar(view.sort_values("within4_12wk", ascending=False), x="PROVIDER", y="within4_12wk", title="A&E 4h % (~12-week avg) — Main vs Peers", labels={"within4_12wk":"4h %"})
             fig.add_hline(y=peer_avg, line_dash="dash", annotation_text=f"Peer avg: {peer_avg:.1f}%")
             st.plotly_chart(fig, use_container_width=True)